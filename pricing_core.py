@@ -0,0 +1,226 @@
+# ==========================================
+# 定价分析核心逻辑：数据读取、清洗、筛选与统计
+# 不含页面元素，供看板页面导入复用 (各页面共享同一份 st.cache_data 缓存)
+# ==========================================
+import codecs
+import hashlib
+import io
+
+import streamlit as st
+import pandas as pd
+import numpy as np
+
+# 可选依赖：安装了 numexpr 时用它做多线程逐元素运算
+try:
+    import numexpr as ne
+except ImportError:
+    ne = None
+
+# --- 智能列名映射：标准列名 -> 各类导出文件中的同义列名 ---
+COL_SYNONYMS = {
+    '单价': ['单价/每吨', '价格/每吨', '单价', 'Price', 'Unit Price'],
+    '销量(吨)': ['第二数量', '数量', 'Qty', 'Quantity', 'Sales Qty'],
+    '国家': ['贸易伙伴名称', '国家', 'Country', 'Partner'],
+}
+REQUIRED_COLS = list(COL_SYNONYMS)
+# 反向索引：同义列名 -> 标准列名，每列一次字典查找
+SYN2CANON = {syn: canon for canon, synonyms in COL_SYNONYMS.items() for syn in synonyms}
+
+# --- 市场类型 (分类编码顺序与名称排序一致，图例/饼图顺序不变) ---
+MARKET_TYPES = ['主流市场', '低价红海', '高价蓝海']
+
+# --- CSV 读取 ---
+def detect_encoding(data, sample_size=65536):
+    # 只检查文件开头判断编码，避免整份文件按 UTF-8 解析失败后再按 GBK 重新解析一遍
+    sample = data[:sample_size]
+    if sample.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    try:
+        # 增量解码：允许样本末尾截断半个多字节字符
+        codecs.getincrementaldecoder('utf-8')().decode(sample, final=False)
+        return 'utf-8'
+    except UnicodeDecodeError:
+        return 'gbk'
+
+def read_csv_fast(file, encoding='utf-8'):
+    # 优先使用 pyarrow 多线程解析；未安装或遇到其不支持的格式时回退到 C 引擎
+    try:
+        return pd.read_csv(file, engine='pyarrow', encoding=encoding)
+    except UnicodeDecodeError:
+        raise  # 编码问题换引擎也无济于事，交给调用方换编码重试
+    except (ImportError, ValueError):
+        file.seek(0)
+        return pd.read_csv(file, engine='c', low_memory=False, encoding=encoding)
+
+# --- Excel 读取 ---
+def _is_known_col(col):
+    return str(col).strip() in SYN2CANON
+
+def read_excel_fast(file):
+    # 只读取能映射到标准列名的列；使用 python-calamine (Rust 实现，比 openpyxl 快数倍，也支持 .xls)，
+    # 环境中缺少 calamine 时退回 pandas 默认引擎 (.xlsx 用 openpyxl 只读模式)
+    try:
+        return pd.read_excel(file, engine='calamine', usecols=_is_known_col)
+    except ImportError:
+        file.seek(0)
+        return pd.read_excel(file, usecols=_is_known_col)
+
+# --- 数据清洗函数 ---
+def file_digest(file_bytes: bytes, filename: str):
+    # 整个文件内容 + 文件名的摘要，作为下游缓存键 (st.cache_data 对 5 万行以上的 DataFrame 只抽样 1 万行哈希，不能直接用订单表做键)
+    h = hashlib.sha1(file_bytes)
+    h.update(filename.encode('utf-8'))
+    return h.hexdigest()
+
+# 以文件内容为缓存键：勾选框、筛选器等交互触发的重跑直接复用已清洗的数据，不再重复解析文件
+@st.cache_data(max_entries=4, ttl=3600, show_spinner=False)
+def load_and_process(file_bytes: bytes, filename: str):
+    # A. 读取文件
+    file = io.BytesIO(file_bytes)
+    try:
+        if filename.endswith('.csv'):
+            encoding = detect_encoding(file_bytes)
+            try:
+                df = read_csv_fast(file, encoding=encoding)
+            except UnicodeDecodeError:
+                # 非 UTF-8 字节出现在抽样范围之后的少见情况
+                if encoding == 'gbk':
+                    raise
+                file.seek(0)
+                df = read_csv_fast(file, encoding='gbk')
+        else:
+            df = read_excel_fast(file)
+    except Exception as e:
+        return None, f"文件读取错误: {e}"
+
+    # B. 列名清洗
+    df.columns = df.columns.str.strip()
+    
+    # C. 智能列名映射
+    df.rename(columns={c: SYN2CANON[c] for c in df.columns if c in SYN2CANON}, inplace=True)
+    
+    # D. 检查必要列
+    if not all(c in df.columns for c in REQUIRED_COLS):
+        return None, f"数据缺失！请确保文件中包含: {REQUIRED_COLS}"
+
+    # E. 数值转换 (先剔除空行以减少转换量；保持 float64，国家汇总和总销量与原始数据逐位一致)
+    df = df.dropna(subset=['单价', '销量(吨)'])
+    for c in ['单价', '销量(吨)']:
+        df[c] = pd.to_numeric(df[c], errors='coerce')
+    
+    # F. 基础过滤 (无法转换的内容已变为空值；空价格与 0 比较为 False，一个掩码同时剔除)
+    df = df[(df['单价'] > 0) & df['销量(吨)'].notna()]
+    
+    # [核心计算] 总销售额 (金额按 float64 计算，保证汇总精度)
+    price = df['单价'].to_numpy(dtype='float64')
+    qty = df['销量(吨)'].to_numpy(dtype='float64')
+    df['总销售额'] = ne.evaluate('price * qty') if ne is not None else price * qty
+
+    # G. 国家转为分类类型：后续分组/筛选按整数编码进行，不再逐行哈希字符串
+    df['国家'] = df['国家'].astype('category')
+    
+    return df, None
+
+# --- 筛选函数 ---
+def price_percentiles(df, q=(25, 50, 75)):
+    # 一次 np.percentile 同时算出多个分位点，避免每个分位点各自排序一遍
+    prices = df['单价'].to_numpy()
+    if prices.size == 0:
+        return tuple(np.nan for _ in q)
+    return tuple(np.percentile(prices, q))
+
+def filter_countries(df, countries):
+    # 按分类编码筛选订单：整数集合判断，不再逐行哈希国家名字符串
+    codes = pd.Categorical(countries, categories=df['国家'].cat.categories).codes
+    # 不在分类中的名称编码为 -1，与空国家行的编码相同，先去掉，避免误选中空国家订单
+    codes = codes[codes >= 0]
+    return df[np.isin(df['国家'].cat.codes.to_numpy(), codes)]
+
+# 只依赖数据与筛选参数：与筛选无关的交互（展开说明、切换图表等）重跑时直接命中缓存
+# 缓存键是 data_key (文件摘要) + 筛选参数；_df 以下划线开头不参与哈希，必须与 data_key 对应
+@st.cache_data(max_entries=16, show_spinner=False)
+def apply_filters(data_key, _df, use_iqr, min_sales, selected_countries=()):
+    df = _df
+    # [筛选1] 极值剔除
+    if use_iqr:
+        Q1, Q3 = price_percentiles(df, (25, 75))
+        IQR = Q3 - Q1
+        # 直接在 NumPy 数组上比较，第二个条件原地合并进掩码，省去中间布尔数组
+        prices = df['单价'].to_numpy()
+        mask = prices >= Q1 - 1.5*IQR
+        mask &= prices <= Q3 + 1.5*IQR
+        df = df[mask]
+
+    # 按国家聚合只做一次：门槛和指定国家都是整国剔除，剩余国家的统计值不受影响，直接筛选聚合结果即可
+    # 国家为分类类型时保留默认 sort：结果按分类编码排序本身几乎无开销，sort=False 反而要按出现顺序重新编码，更慢
+    country_stats = df.groupby('国家', observed=True).agg(**{
+        '单价': ('单价', 'median'),
+        '销量(吨)': ('销量(吨)', 'sum'),
+        '总销售额': ('总销售额', 'sum'),
+        '订单数': ('单价', 'size'),
+    }).reset_index()
+
+    # [筛选2] 销售额门槛筛选
+    keep = country_stats['总销售额'] >= min_sales
+
+    # [筛选3] 指定国家
+    if selected_countries:
+        keep &= country_stats['国家'].isin(selected_countries)
+
+    country_stats = country_stats[keep].reset_index(drop=True)
+    df = filter_countries(df, country_stats['国家'])
+
+    # 筛选后数据的 Q1/中位数/Q3，供市场分类、统计卡片和图表参考线复用
+    p25, p50, p75 = price_percentiles(df)
+
+    return df, country_stats, p25, p50, p75
+
+# --- 统计函数 ---
+def classify_market(prices, p25, p75):
+    # 以 int8 编码存储的分类列：每个国家 1 字节，分组/配色按编码进行
+    codes = np.select([prices >= p75, prices <= p25], [2, 1], default=0).astype('int8')
+    return pd.Categorical.from_codes(codes, MARKET_TYPES)
+
+# 输入是按国家聚合后的小表，哈希与计算都只与国家数有关
+@st.cache_data(max_entries=16, show_spinner=False)
+def build_country_stats(country_stats, p25, p75):
+    country_stats = country_stats.assign(市场类型=classify_market(country_stats['单价'].to_numpy(), p25, p75))
+
+    # 计算整体加权平均价 (各国汇总之和即筛选后全部订单的合计，无需再扫描订单明细)
+    total_rev = country_stats['总销售额'].sum()
+    total_vol = country_stats['销量(吨)'].sum()
+    avg_price_weighted = total_rev / total_vol if total_vol > 0 else 0
+
+    return country_stats, total_rev, total_vol, avg_price_weighted
+
+def price_box_stats(df):
+    # 在服务端算好各国箱线图统计量 (与 Plotly 相同：须线延伸到 1.5 倍 IQR 内的最远订单)，按中位价从高到低排列
+    # 四分位数按 Plotly 默认的 quartilemethod='linear' 计算，即 hazen 插值 (pandas quantile 的插值方式不同)；只有 20 个国家，逐国计算开销很小
+    g = df.groupby('国家', observed=True)['单价']
+    quartiles = {country: np.percentile(p.to_numpy(), [25, 50, 75], method='hazen') for country, p in g}
+    stats = pd.DataFrame.from_dict(quartiles, orient='index', columns=['q1', 'median', 'q3'])
+    iqr = stats['q3'] - stats['q1']
+
+    # 把各国的须线界限按分类编码展开到每一行，一次比较得出 1.5 倍 IQR 内外的订单
+    codes = df['国家'].cat.codes.to_numpy()
+    categories = df['国家'].cat.categories
+    lo = (stats['q1'] - 1.5*iqr).reindex(categories).to_numpy()[codes]
+    hi = (stats['q3'] + 1.5*iqr).reindex(categories).to_numpy()[codes]
+    prices = df['单价'].to_numpy()
+    inside = (prices >= lo) & (prices <= hi)
+
+    fences = df[inside].groupby('国家', observed=True)['单价'].agg(['min', 'max'])
+    stats['lowerfence'] = fences['min']
+    stats['upperfence'] = fences['max']
+    outliers = df.loc[~inside, ['国家', '单价']]
+
+    return stats.sort_values('median', ascending=False), outliers
+
+# --- 导出函数 ---
+# 每次重跑都会生成下载内容，缓存后同一份结果只序列化一次
+@st.cache_data(max_entries=16, show_spinner=False)
+def to_csv_bytes(df):
+    # 分块编码直接写入字节缓冲区，不在内存中同时保留完整的 CSV 字符串和编码后的副本
+    buf = io.BytesIO()
+    df.to_csv(buf, index=False, encoding='utf-8-sig')
+    return buf.getvalue()